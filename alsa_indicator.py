@@ -34,10 +34,12 @@ __status__ = "Production"
 __version__ = "0.0.1"
 
 import os
-import glob
-import re
+import io
+import ctypes
+import functools
+import select
+import signal
 import serial
-import time
 import logging
 import configparser
 
@@ -56,20 +58,13 @@ class NoSerialDevice(Exception):
     pass
 
 
-def read_config_info(config_file):
+@functools.lru_cache(maxsize=4)
+def _read_config_cached(config_file, mtime_ns):
     """
-    Read the config variables into a dictionary
-
-    Variables are
-    LOGGING
-        LOG_LEVEL (as per keys to log_level _info below and corresponding to Python standard library Logging
-        IGNORE_SERIAL_ERROR - Boolean - set to True if testing alsa code without serial device attached
-    SERIAL
-        PORT - serial port for attached sample-rate indicator device
-        BAUDRATE - baud rate for the above
-        SAMPLE_SECONDS - rate at which to re-check alsa for sample_rate and bit_depth of any playing audio
+    Parse the config file - cached on (path, mtime) so unchanged files are never reparsed
 
     :param: config_file: standard configparser config file
+    :param: mtime_ns: the file's st_mtime_ns, included purely to invalidate the cache on edits
     :return: _config_info: dictionary containing the parsed config variables
     """
     _config_info = {}
@@ -84,29 +79,214 @@ def read_config_info(config_file):
     _config_info['log_level'] = log_level_info.get(config['LOGGING']['LOG_LEVEL'], logging.ERROR)
     _config_info['ignore_serial_error'] = config.getboolean('LOGGING', 'IGNORE_SERIAL_ERROR')
     _config_info['serial_port'] = config['SERIAL']['PORT']
-    _config_info['baud_rate'] = config['SERIAL']['BAUDRATE']
+    _config_info['baud_rate'] = config.getint('SERIAL', 'BAUDRATE')
     _config_info['sample_time_seconds'] = config.getint('SERIAL', 'SAMPLE_SECONDS')
     return _config_info
 
 
-def find_active_soundcard():
+def read_config_info(config_file):
     """
-    Searches all cards defined to alsa and returns the first one with status=RUNNING
+    Read the config variables into a dictionary
 
-    :return: _soundcard: the fully qualified name of the active alsa soundcard subdevice '/proc/asound/card?/pcm?p/sub?'
+    Variables are
+    LOGGING
+        LOG_LEVEL (as per keys to log_level _info below and corresponding to Python standard library Logging
+        IGNORE_SERIAL_ERROR - Boolean - set to True if testing alsa code without serial device attached
+    SERIAL
+        PORT - serial port for attached sample-rate indicator device
+        BAUDRATE - baud rate for the above
+        SAMPLE_SECONDS - rate at which to re-check alsa for sample_rate and bit_depth of any playing audio
+
+    Re-reads (e.g. a future SIGHUP reload) are served from the cache unless the file's mtime has
+    changed, so callers can invoke this as often as they like
+
+    :param: config_file: standard configparser config file
+    :return: _config_info: dictionary containing the parsed config variables
+    """
+    try:
+        mtime_ns = os.stat(config_file).st_mtime_ns
+    except (FileNotFoundError, IOError):
+        mtime_ns = 0  # configparser treats a missing file as empty; keep that behaviour
+    return _read_config_cached(config_file, mtime_ns)
+
+
+# Encoding tables for serial_dev_write - hoisted to module scope so they are built once, not per write
+_SAMPLE_RATE_CODE = {0: 0, 44100: 1 * 8, 48000: 2 * 8, 88200: 3 * 8, 96000: 4 * 8, 176400: 5 * 8, 192000: 6 * 8,
+                     352800: 7 * 8, 384000: 8 * 8, -1: 9 * 8}
+_BIT_DEPTH_CODE = {0: 0, 16: 1, 24: 2, 32: 3, -1: 4}
+assert all(code < 80 for code in _SAMPLE_RATE_CODE.values()), "sample rate code out of range"
+_FALLBACK_BYTES = str(_SAMPLE_RATE_CODE[-1] + _BIT_DEPTH_CODE[-1]).encode('utf-8')
+# Final wire payload for every (sample_rate, bit_depth) pair, so the write path is a single dict lookup
+_ENCODE = {(rate, depth): str(rate_code + depth_code).encode('utf-8')
+           for rate, rate_code in _SAMPLE_RATE_CODE.items()
+           for depth, depth_code in _BIT_DEPTH_CODE.items()}
+
+# inotify event masks (from linux/inotify.h) - used for event-driven wakeups of the poll loop
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+
+# Preallocated read buffer for the tiny ALSA proc files - reused every poll to avoid allocation churn
+_BUF = bytearray(2048)
+
+# Last payload successfully written to the serial device - steady-state ticks skip the redundant write
+_last_payload = None
+
+# Candidate subdevice paths are cached so /proc/asound is not re-scanned on every poll
+_CARD_CACHE_TTL_TICKS = 30
+_card_cache = []
+_card_cache_ticks = _CARD_CACHE_TTL_TICKS
+
+
+def _iter_sub_devices():
+    """
+    Yields all playback subdevice paths '/proc/asound/card?/pcm?p/sub?' known to alsa
+
+    A hand-rolled os.scandir walk is used rather than glob - it skips the fnmatch machinery and
+    reuses the cached DirEntry information for each directory level
+
+    :return: generator of subdevice paths
     """
-    for sub_device in glob.glob(f'/proc/asound/card**/pcm**p/sub*'):
+    try:
+        # is_dir() checks keep regular files like /proc/asound/cards (which matches the 'card'
+        # prefix) from aborting the walk and dropping the cards not yet yielded
+        for card in os.scandir('/proc/asound'):
+            if not (card.name.startswith('card') and card.is_dir()):
+                continue
+            for pcm in os.scandir(card.path):
+                if not (pcm.name.startswith('pcm') and pcm.name.endswith('p') and pcm.is_dir()):
+                    continue
+                for sub in os.scandir(pcm.path):
+                    if sub.name.startswith('sub') and sub.is_dir():
+                        yield sub.path
+    except (FileNotFoundError, NotADirectoryError, IOError):
+        return
+
+
+def inotify_setup():
+    """
+    Best-effort inotify over the known subdevice status files so the main loop can block instead of spin
+
+    Watches each '/proc/asound/card?/pcm?p/sub?/status' for modify/close-write and /proc/asound
+    itself for card hot-plug. procfs does not reliably deliver modify events, so the timed poll in
+    the main loop remains authoritative - inotify events just wake it early when the kernel does
+    report them
+
+    :return: the inotify file descriptor, or None if inotify is unavailable
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(0)
+        if fd < 0:
+            return None
+        for sub_device in _iter_sub_devices():
+            libc.inotify_add_watch(fd, os.path.join(sub_device, 'status').encode(),
+                                   _IN_MODIFY | _IN_CLOSE_WRITE)
+        libc.inotify_add_watch(fd, b'/proc/asound', _IN_CREATE | _IN_DELETE)
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _probe_sub_devices(sub_devices):
+    """
+    Checks each subdevice's status for RUNNING and, on a hit, reads and parses its hw_params
+
+    Once a RUNNING subdevice is found its hw_params file is read straight away with the same raw
+    os.open/os.read primitives, so there is no second round-trip per device
+
+    :param: sub_devices: iterable of subdevice paths '/proc/asound/card?/pcm?p/sub?'
+    :return: (_soundcard, _sample_rate, _bit_depth) for the first RUNNING subdevice, or None
+    """
+    for sub_device in sub_devices:
         try:
-            with open(os.path.join(sub_device, 'status'), 'r') as f:
-                status = f.read()
-            if "RUNNING" in status:
-                log.info(sub_device)
-                log.info(status)
-                _soundcard = sub_device
-                return _soundcard
+            fd = os.open(os.path.join(sub_device, 'status'), os.O_RDONLY)
+            try:
+                status = os.read(fd, 4096)
+            finally:
+                os.close(fd)
+            if b"RUNNING" in status:  # Match on the raw bytes - no need to decode the whole file
+                if log.isEnabledFor(logging.INFO):
+                    log.info("%s", sub_device)
+                    log.info("%s", status.decode('ascii', 'ignore'))
+                fd = os.open(os.path.join(sub_device, 'hw_params'), os.O_RDONLY)
+                try:
+                    n = os.readv(fd, [_BUF])
+                finally:
+                    os.close(fd)
+                result = _parse_hw_params(_BUF[:n])
+                if result is not None:
+                    _sample_rate, _bit_depth = result
+                    return sub_device, _sample_rate, _bit_depth
         except (FileNotFoundError, IOError):
             pass
-    raise NoActiveSoundcard
+    return None
+
+
+def _scan_for_active():
+    """
+    Single sweep over the subdevices - probes the cached path list, refreshing it when needed
+
+    The scan of /proc/asound is refreshed every _CARD_CACHE_TTL_TICKS calls, and also immediately
+    after a probe miss on a stale list - a miss may just mean a newly plugged-in card is not in
+    the cache yet, so only hits are served from a stale list
+
+    :return: (_soundcard, _sample_rate, _bit_depth) for the first RUNNING subdevice, or None
+    """
+    global _card_cache, _card_cache_ticks
+    _card_cache_ticks += 1
+    fresh = not _card_cache or _card_cache_ticks >= _CARD_CACHE_TTL_TICKS
+    if fresh:
+        _card_cache = list(_iter_sub_devices())
+        _card_cache_ticks = 0
+    result = _probe_sub_devices(_card_cache)
+    if result is None and not fresh:
+        _card_cache = list(_iter_sub_devices())
+        _card_cache_ticks = 0
+        result = _probe_sub_devices(_card_cache)
+    return result
+
+
+def find_active_soundcard():
+    """
+    Searches all cards defined to alsa and returns the first one with status=RUNNING
+
+    Thin wrapper around _scan_for_active for callers that only want the path
+
+    :return: _soundcard: the fully qualified name of the active alsa soundcard subdevice '/proc/asound/card?/pcm?p/sub?'
+    """
+    result = _scan_for_active()
+    if result is None:
+        raise NoActiveSoundcard
+    return result[0]
+
+
+def _parse_hw_params(hw_params):
+    """
+    Extracts the sample_rate and bit_depth from the text of a subdevice's hw_params file
+
+    Parse misses are expected whenever playback stops, so they are reported as a None return
+    rather than an exception - unwinding a raise every poll is needless overhead
+
+    :param: hw_params: the raw bytes of a '/proc/asound/card?/pcm?p/sub?/hw_params' file
+    :return: (_sample_rate, _bit_depth) as ints, or None if the file does not describe active playback
+    """
+    # hw_params is a small ascii key:value block - slice the numbers straight out of the bytes,
+    # no regex and no text decoding needed
+    fmt_start = hw_params.find(b'format: S')
+    fmt_end = hw_params.find(b'_LE', fmt_start)
+    rate_start = hw_params.find(b'rate: ')
+    rate_end = hw_params.find(b' (', rate_start)
+    if -1 in (fmt_start, fmt_end, rate_start, rate_end):
+        return None
+    try:
+        _sample_rate = int(hw_params[rate_start + 6:rate_end])
+        _bit_depth = int(hw_params[fmt_start + 9:fmt_end])
+    except ValueError:
+        return None
+    log.info("%s", hw_params)
+    return _sample_rate, _bit_depth
 
 
 def find_sample_rate_bit_depth(_soundcard):
@@ -114,39 +294,32 @@ def find_sample_rate_bit_depth(_soundcard):
     Returns the sample_rate and bit_depth currently being played on the input soundcard
 
     :param: _soundcard: the fully qualified name of the active alsa soundcard subdevice '/proc/asound/card?/pcm?p/sub?'
-    :return: _sample_rate: the sample rate of currently playing sound, from the file 'hw_parms' of the input soundcard
-    :return: _bit_depth: the bit depth of currently playing sound, from the file 'hw_parms' of the input soundcard
+    :return: (_sample_rate, _bit_depth) from the soundcard's 'hw_params' file, or None if it is no
+             longer playing
     """
-    bit_depth_pattern = r"format: S([0-9]+)_LE"
-    sample_rate_pattern = r"rate: ([0-9]+) \("
     try:
-        with open(f"{_soundcard}/hw_params", 'r') as f:
-            hw_params = f.read()
+        fd = os.open(f"{_soundcard}/hw_params", os.O_RDONLY)
         try:
-            _sample_rate = re.search(sample_rate_pattern, hw_params).group(1)
-            _bit_depth = re.search(bit_depth_pattern, hw_params).group(1)
-            log.info(hw_params)
-            return _sample_rate, _bit_depth
-        except AttributeError:
-            raise NoActiveSoundcard
+            n = os.readv(fd, [_BUF])
+        finally:
+            os.close(fd)
     except (FileNotFoundError, IOError):
-        raise NoActiveSoundcard
+        return None
+    return _parse_hw_params(_BUF[:n])
 
 
 def find_new_soundcard_and_sample_rate():
     """
-    Combines find_active_soundcard and find_sample_rate_bit_depth into one helper function
+    Finds the active soundcard and its playback parameters in a single sweep via _scan_for_active
 
     :return: _soundcard: the fully qualified name of the active alsa soundcard subdevice '/proc/asound/card?/pcm?p/sub?'
     :return: _sample_rate: the sample rate of currently playing sound, from the file 'hw_parms' of the input soundcard
     :return: _bit_depth: the bit depth of currently playing sound, from the file 'hw_parms' of the input soundcard
     """
-    try:
-        _soundcard = find_active_soundcard()
-        _sample_rate, _bit_depth = find_sample_rate_bit_depth(_soundcard)
-    except NoActiveSoundcard:
-        _soundcard, _sample_rate, _bit_depth = None, 0, 0
-    return _soundcard, _sample_rate, _bit_depth
+    result = _scan_for_active()
+    if result is None:
+        return None, 0, 0
+    return result
 
 
 def signal_sample_rate(_soundcard):
@@ -157,10 +330,11 @@ def signal_sample_rate(_soundcard):
     :return: _soundcard: the fully qualified name of the active alsa soundcard subdevice '/proc/asound/card?/pcm?p/sub?'
              This may be different to the input parameter if _soundcard had been stopped, started, or changed
     """
-    try:  # Assume the last active soundcard is still Active
-        _sample_rate, _bit_depth = find_sample_rate_bit_depth(_soundcard)
-    except NoActiveSoundcard:  # Nope, it's changed - maybe turned on/off or maybe user chase a different soundcard
+    result = find_sample_rate_bit_depth(_soundcard)  # Assume the last active soundcard is still Active
+    if result is None:  # Nope, it's changed - maybe turned on/off or maybe user chase a different soundcard
         _soundcard, _sample_rate, _bit_depth = find_new_soundcard_and_sample_rate()
+    else:
+        _sample_rate, _bit_depth = result
     serial_dev_write(serial_dev, _sample_rate, _bit_depth)  # Write sample_rate/bit_depth to the serial device
     return _soundcard
 
@@ -179,7 +353,9 @@ def serial_dev_init(_serial_port, _baud_rate):
     """
     try:
         _serial_dev = serial.Serial(port=_serial_port, baudrate=_baud_rate, timeout=.1)
-        return _serial_dev
+        # Serial subclasses io.RawIOBase, so it can sit under a BufferedWriter - writes are
+        # accumulated and only hit the wire on flush, letting multi-byte frames share one syscall
+        return io.BufferedWriter(_serial_dev, buffer_size=64)
     except serial.SerialException:
         if not ignore_serial_error:
             raise NoSerialDevice
@@ -189,9 +365,9 @@ def serial_dev_init(_serial_port, _baud_rate):
 def serial_dev_write(_serial_dev, _sample_rate, _bit_depth):
     """
     Write the encoded sample_rate and bit_depth encoded to the serial port
-    Encoding is sample_rate_index*8+bit_depth_index - the indexes are from sample_rate_dict and bit_depth_dict
+    Encoding is sample_rate_index*8+bit_depth_index - the indexes are from _SAMPLE_RATE_CODE and _BIT_DEPTH_CODE
     Should be able to send as an integer, but I can't make this work so encode as a single char
-    Note, not sound card has sample_rate=0 and invalid/unknown sample_rate will be sent as sample_rate_dict[-1]
+    Note, not sound card has sample_rate=0 and invalid/unknown sample_rate will be sent as _SAMPLE_RATE_CODE[-1]
     Code in the serial device is responsible for decoding these values
 
     If we want just to test the alsa code, getting the soundcard and sample_rate etc. then ignore_serial_error can be
@@ -202,18 +378,18 @@ def serial_dev_write(_serial_dev, _sample_rate, _bit_depth):
     :param: _bit_depth: the bit depth of currently playing sound, from the file 'hw_parms' of the input soundcard
     """
 
-    sample_rate_dict = {0: 0, 44100: 1 * 8, 48000: 2 * 8, 88200: 3 * 8, 96000: 4 * 8, 176400: 5 * 8, 192000: 6 * 8,
-                        3528000: 7 * 8, 384000: 8 * 8, -1: 9 * 8}
-    bit_depth_dict = {0: 0, 16: 1, 24: 2, 32: 3, -1: 4}
+    global _last_payload
 
-    log.info(f"Sample_rate = {_sample_rate}, bit_depth= {_bit_depth}")
+    # %-style args so the formatting only happens when a handler actually accepts INFO records
+    log.info("Sample_rate = %s, bit_depth= %s", _sample_rate, _bit_depth)
+    payload = _ENCODE.get((_sample_rate, _bit_depth), _FALLBACK_BYTES)
+    if payload == _last_payload:  # Steady-state playback - the device already shows this, skip the USB frame
+        return
+    log.info("%s", payload)
     try:
-        serial_val = str(sample_rate_dict[int(_sample_rate)] + bit_depth_dict[int(_bit_depth)])
-    except KeyError:
-        serial_val = str(sample_rate_dict[-1] + bit_depth_dict[-1])
-    log.info(serial_val)
-    try:
-        _serial_dev.write(bytes(serial_val, 'utf-8'))
+        _serial_dev.write(payload)
+        _serial_dev.flush()  # Payload has changed, push it to the device now
+        _last_payload = payload
     except AttributeError:
         if not ignore_serial_error:
             raise NoSerialDevice
@@ -245,9 +421,32 @@ if __name__ == "__main__":
     sample_time_seconds = config_info['sample_time_seconds']
 
     soundcard = None
+    idle_sleep = sample_time_seconds
+    inotify_fd = inotify_setup()
+
+    # SIGTERM (e.g. from systemd) gets a Python-level handler so it exits cleanly rather than
+    # killing the process mid-write - and only handled signals reach the wakeup fd below
+    def _handle_sigterm(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+
+    # Self-pipe written when a handled signal is delivered, so shutdown requests wake the wait
+    # promptly instead of the process sitting out the remainder of the poll interval
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+
+    wait_fds = [wake_r] if inotify_fd is None else [wake_r, inotify_fd]
 
     log.info("Setup complete")
 
     while True:
         soundcard = signal_sample_rate(soundcard)
-        time.sleep(sample_time_seconds)
+        if soundcard is None:  # Nothing playing - back off the poll rate (capped) to cut idle wakeups
+            idle_sleep = min(idle_sleep * 2, 60)
+        else:
+            idle_sleep = sample_time_seconds
+        readable, _, _ = select.select(wait_fds, [], [], idle_sleep)
+        for fd in readable:  # Drain - the next signal_sample_rate re-reads everything anyway
+            os.read(fd, 4096)